@@ -2,12 +2,19 @@ from dotenv import load_dotenv
 import os
 import imaplib
 import email
+import email.policy
+import binascii
+import quopri
 import re
+from dataclasses import dataclass
 from datetime import datetime
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import configparser
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
 
 # Load environment variables from the .env file
@@ -21,92 +28,456 @@ config_full_path = os.path.join(os.getcwd(), config_path, "config.ini")
 config = configparser.ConfigParser()
 config.read(config_full_path)
 
-# Retrieve and process email recipients from the configuration file
+
+# Settings resolved once at startup
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """
+    Holds the email, SMTP and SFTP settings from the environment and the configuration file.
+    """
+    email_hostname: str
+    email_username: str
+    email_password: str
+    email_recipients: tuple
+    smtp_server: str
+    smtp_sender_email: str
+    smtp_sender_password: str
+    sftp_hostname: str
+    sftp_port: int
+    sftp_username: str
+    sftp_password: str
+    local_file_path: str
+    remote_path: str
+
+    @classmethod
+    def load(cls, config):
+        """
+        Loads the settings from environment variables and the parsed configuration file.
+
+        :param config: Parsed configuration file
+        :return: Settings instance
+        :raises KeyError: If an environment variable or configuration key is missing
+        """
+        return cls(
+            email_hostname=os.environ['EMAIL_HOSTNAME'],
+            email_username=os.environ['EMAIL_USERNAME'],
+            email_password=os.environ['EMAIL_PASSWORD'],
+            email_recipients=tuple(recipient.strip() for recipient in config['EMAIL']['recipients'].split(',')),
+            smtp_server=os.environ['SMTP_SERVER'],
+            smtp_sender_email=os.environ['SMTP_SENDER_EMAIL'],
+            smtp_sender_password=os.environ['SMTP_SENDER_PASSWORD'],
+            sftp_hostname=os.environ['SFTP_HOSTNAME'],
+            sftp_port=int(os.environ['SFTP_PORT']),
+            sftp_username=os.environ['SFTP_USERNAME'],
+            sftp_password=os.environ['SFTP_PWORD'],
+            local_file_path=os.environ['LOCAL_FILE_PATH'],
+            remote_path=os.environ['REMOTE_PATH'],
+        )
+
+
+# Load the settings, failing at startup if any of them is missing
 try:
-    EMAIL_RECIPIENTS = [email.strip() for email in config['EMAIL']['recipients'].split(',')]
+    settings = Settings.load(config)
 except KeyError as e:
-    print(f"Error: {e}. Check if 'EMAIL' section exists in the config file.")
+    print(f"Error: {e}. Check the .env file and that the 'EMAIL' section exists in the config file.")
+    raise
 
-# Load email server configuration from environment variables
-hostname = os.getenv('EMAIL_HOSTNAME')
-username = os.getenv('EMAIL_USERNAME')
-password = os.getenv('EMAIL_PASSWORD')
+# Pattern for the SKU/UPC column layout in the incoming closeout emails; fields are
+# separated by whitespace other than newlines so a match never spans two lines
+_SKU_RE = re.compile(r'^[^\S\n]*(\d)[^\S\n]+(\d{5})[^\S\n]+(\d{5})[^\S\n]+(\d)[^\S\n]+P', re.MULTILINE)
 
+# Pattern for the sequence number that starts each untagged FETCH response
+_FETCH_START_RE = re.compile(rb'\d+ \(')
 
-# Function to upload files via SFTP
-def sftp_upload_file(hostname, port, username, password, local_file, remote_path):
+# Pattern for the filename embedded within square brackets in a subject line
+_FILENAME_RE = re.compile(r'\[([^\]]+)\]')
+
+# Block size for pipelined SFTP writes (kept under OpenSSH's 256 KB packet limit)
+SFTP_BLOCK_SIZE = 128 * 1024
+
+# Kernel socket buffer size for the SFTP connection
+SFTP_SOCKET_BUFFER_SIZE = 32 * 1024 * 1024
+
+# Number of messages handled concurrently
+MAX_WORKERS = 8
+
+# Subject prefix of the approval emails, also present in the replies to them
+APPROVAL_SUBJECT = "DSVNord Closeout Approval"
+
+
+# Tune a TCP socket for the mail and SFTP connections
+def tune_socket(sock, buffer_size=None):
     """
-    Uploads a file to a remote server via SFTP.
+    Disables Nagle's algorithm on a TCP socket and optionally enlarges its kernel buffers.
+
+    Buffer sizes only take full effect when set before the socket connects, since the
+    TCP window scale is negotiated during the handshake.
+    :param sock: TCP socket
+    :param buffer_size: Send and receive buffer size in bytes, or None to keep the defaults
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+
+
+# Open a TCP connection whose socket is tuned before it connects
+def create_tuned_connection(hostname, port, buffer_size=None):
+    """
+    Connects to a server like socket.create_connection, tuning the socket before the handshake.
+
+    :param hostname: Server hostname
+    :param port: Server port
+    :param buffer_size: Send and receive buffer size in bytes, or None to keep the defaults
+    :return: Connected TCP socket
+    """
+    error = None
+    for family, sock_type, proto, _, address in socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(family, sock_type, proto)
+        try:
+            tune_socket(sock, buffer_size)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error or OSError(f"No addresses found for {hostname}")
+
+
+# IMAP over SSL with a tuned socket
+class TunedIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    IMAP4_SSL client whose socket has Nagle's algorithm disabled.
+    """
+
+    def _create_socket(self, timeout):
+        """
+        Creates the SSL socket for the connection with TCP_NODELAY set.
+
+        :param timeout: Connection timeout in seconds, or None
+        :return: Connected SSL socket
+        """
+        sock = super()._create_socket(timeout)
+        tune_socket(sock)
+        return sock
+
+
+# Open an SFTP session that can be reused for several uploads
+def connect_sftp(hostname, port, username, password):
+    """
+    Connects to a remote server and opens an SFTP session.
 
     :param hostname: SFTP server hostname
     :param port: SFTP server port
     :param username: SFTP username
     :param password: SFTP password
+    :return: Tuple of the connected SSH client and its SFTP session
+    """
+    # Initialize the SSH client
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    # Pre-create the socket so it can be tuned for bulk transfer
+    sock = create_tuned_connection(hostname, port, SFTP_SOCKET_BUFFER_SIZE)
+    try:
+        ssh_client.connect(hostname, port=port, username=username, password=password, sock=sock)
+        return ssh_client, ssh_client.open_sftp()
+    except Exception:
+        ssh_client.close()
+        sock.close()
+        raise
+
+
+# Function to upload files via SFTP
+def sftp_upload_file(sftp, local_file, remote_path):
+    """
+    Uploads a file to a remote server via SFTP.
+
+    :param sftp: Open SFTP session
     :param local_file: Path to the local file to be uploaded
     :param remote_path: Remote path where the file should be uploaded
     """
     try:
-        # Initialize and connect to the SSH client
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname, port=port, username=username, password=password)
-
-        # Open an SFTP session and upload the file
-        with ssh_client.open_sftp() as sftp:
-            sftp.put(local_file, remote_path + os.path.basename(local_file))
-            print("File uploaded successfully")
+        # Upload the file with pipelined writes; each write returns without waiting
+        # for the server's ACK, so many write requests are in flight at once
+        with open(local_file, 'rb') as lf, \
+                sftp.file(remote_path + os.path.basename(local_file), 'wb', 0) as rf:
+            rf.set_pipelined(True)
+            rf.MAX_REQUEST_SIZE = SFTP_BLOCK_SIZE
+
+            # The remote file is unbuffered, so each chunk goes straight into a write
+            # request instead of first being copied into a write buffer
+            total = 0
+            while chunk := lf.read(SFTP_BLOCK_SIZE):
+                rf.write(chunk)
+                total += len(chunk)
+
+            # Pipelined write errors are only reported later, so confirm the remote size
+            remote_size = rf.stat().st_size
+        if remote_size != total:
+            raise IOError(f"size mismatch in upload: {remote_size} != {total}")
+        print("File uploaded successfully")
     except Exception as e:
         print(f"Error during SFTP upload: {e}")
-    finally:
-        ssh_client.close()
+        raise
+
+
+# Open an SMTP connection that can be reused for several emails
+def connect_smtp():
+    """
+    Connects and logs in to the SMTP server with the sender account.
+
+    :return: Authenticated SMTP connection
+    """
+    server = smtplib.SMTP(settings.smtp_server, 587)
+    try:
+        tune_socket(server.sock)
+        server.starttls()
+        server.login(settings.smtp_sender_email, settings.smtp_sender_password)
+    except Exception:
+        server.close()
+        raise
+    return server
 
 
 # Function to send emails
-def send_email(subject, body, to_emails):
+def send_email(server, subject, body, to_emails):
     """
     Sends an email to specified recipients.
 
+    :param server: Authenticated SMTP connection
     :param subject: Email subject
     :param body: Email body content
     :param to_emails: List of email recipients
     """
     # Set up email details
-    sender_email = os.getenv("SMTP_SENDER_EMAIL")
-    sender_password = os.getenv("SMTP_SENDER_PASSWORD")
     message = MIMEMultipart()
-    message["From"] = sender_email
+    message["From"] = settings.smtp_sender_email
     message["To"] = ", ".join(to_emails)
     message["Subject"] = subject
     message.attach(MIMEText(body, 'plain'))
 
     # Send the email
     try:
-        server = smtplib.SMTP(os.getenv("SMTP_SERVER"), 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, to_emails, message.as_string())
-        server.close()
+        server.sendmail(settings.smtp_sender_email, to_emails, message.as_string())
         print("Email sent successfully")
     except Exception as e:
         print(f"Error sending email: {e}")
+        raise
 
 
-# Extract the body content from an email message
-def get_email_body(msg):
+# Decode the body content of a text part
+def get_email_body(content, charset, encoding):
     """
-    Extracts the body content from an email message.
-
-    The function handles both multipart and singlepart emails.
-    :param msg: Email message object
+    Decodes the raw content of a text body part into a string.
+
+    The transfer encoding is undone once on the fetched bytes, which are then decoded
+    with the part's declared charset (UTF-8 when none is declared), replacing any
+    undecodable bytes.
+    :param content: Raw bytes of the body part as fetched from the server
+    :param charset: Charset declared for the part, or None
+    :param encoding: Content-Transfer-Encoding of the part
     :return: Body content of the email
     """
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get('Content-Disposition'))
-            if "attachment" not in content_disposition and content_type in ["text/plain", "text/html"]:
-                return part.get_payload(decode=True).decode()
-    return msg.get_payload(decode=True).decode()
+    encoding = encoding.lower()
+    if encoding == 'base64':
+        try:
+            content = binascii.a2b_base64(content)
+        except binascii.Error:
+            # Let the email package recover what it can from malformed base64
+            part = email.message_from_bytes(b'Content-Transfer-Encoding: base64\r\n\r\n' + content)
+            content = part.get_payload(decode=True)
+    elif encoding == 'quoted-printable':
+        content = quopri.decodestring(content)
+    try:
+        return content.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+
+# Tokenize a raw IMAP response into nested lists
+def _parse_imap_tokens(raw):
+    """
+    Parses raw IMAP response bytes into nested lists of atoms, strings and literals.
+
+    :param raw: Response bytes with literals inlined as {size}CRLF<data>
+    :return: List of top-level tokens; parenthesized lists become nested lists and NIL becomes None
+    """
+    stack = [[]]
+    i, n = 0, len(raw)
+    while i < n:
+        c = raw[i:i + 1]
+        if c in (b' ', b'\r', b'\n'):
+            i += 1
+        elif c == b'(':
+            stack.append([])
+            i += 1
+        elif c == b')':
+            closed = stack.pop()
+            stack[-1].append(closed)
+            i += 1
+        elif c == b'"':
+            buf = bytearray()
+            i += 1
+            while i < n and raw[i:i + 1] != b'"':
+                if raw[i:i + 1] == b'\\':
+                    i += 1
+                buf += raw[i:i + 1]
+                i += 1
+            stack[-1].append(bytes(buf))
+            i += 1
+        elif c == b'{':
+            end = raw.index(b'}', i)
+            size = int(raw[i + 1:end])
+            start = raw.index(b'\n', end) + 1
+            stack[-1].append(raw[start:start + size])
+            i = start + size
+        else:
+            j = i
+            while j < n and raw[j:j + 1] not in (b' ', b'(', b')', b'\r', b'\n', b'"'):
+                # Section specifiers such as BODY[HEADER.FIELDS (SUBJECT)] belong to the atom;
+                # a '[' without a closing ']' is an ordinary atom character
+                if raw[j:j + 1] == b'[':
+                    j = max(raw.find(b']', j), j)
+                j += 1
+            atom = raw[i:j]
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+            i = j
+    return stack[0]
+
+
+# Parse the data returned by an IMAP FETCH command
+def parse_fetch_response(data):
+    """
+    Parses the data returned by imaplib for a FETCH into one dictionary per message.
+
+    Each response is parsed on its own, so one that cannot be parsed is reported and
+    skipped without affecting the others. Responses for the same UID are merged, and
+    unsolicited responses without a UID (such as flag updates) are skipped.
+    :param data: Response data list as returned by imaplib
+    :return: Mapping of message UID to a dictionary of upper-cased data item names and their values
+    """
+    # Regroup imaplib's parts into one raw response per message; a new response starts
+    # with its sequence number, while the text following a literal continues the current one
+    responses = []
+    for part in data:
+        if not part:
+            continue
+        head = part[0] if isinstance(part, tuple) else part
+        chunk = part[0] + b'\r\n' + part[1] if isinstance(part, tuple) else part
+        if _FETCH_START_RE.match(head) or not responses:
+            responses.append(chunk)
+        else:
+            responses[-1] += chunk
+
+    items = {}
+    for raw in responses:
+        try:
+            tokens = _parse_imap_tokens(raw)
+        except Exception as e:
+            print(f"Error parsing FETCH response {raw[:80]!r}: {e}")
+            continue
+        for token in tokens:
+            if isinstance(token, list):
+                item = {key.upper(): value for key, value in zip(token[::2], token[1::2])
+                        if isinstance(key, bytes)}
+                uid = item.get(b'UID')
+                if uid is not None:
+                    items.setdefault(uid, {}).update(item)
+    return items
+
+
+# Collect the text parts of a parsed BODYSTRUCTURE
+def _iter_text_parts(structure, section=None):
+    """
+    Yields every non-attachment text part within a parsed BODYSTRUCTURE.
+
+    :param structure: Parsed BODYSTRUCTURE (or a nested part of it)
+    :param section: IMAP section number of the structure, None for the whole message
+    :return: Generator of (section, subtype, charset, encoding) tuples
+    """
+    if isinstance(structure[0], list):
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            yield from _iter_text_parts(child, f'{section}.{index}' if section else str(index))
+    elif structure[0].upper() == b'TEXT':
+        disposition = structure[9] if len(structure) > 9 else None
+        if isinstance(disposition, list) and disposition[0] and disposition[0].upper() == b'ATTACHMENT':
+            return
+        params = structure[2] or []
+        charset = next((value for key, value in zip(params[::2], params[1::2]) if key.upper() == b'CHARSET'), None)
+        yield (section or '1',
+               structure[1].decode('ascii', 'replace').lower(),
+               charset.decode('ascii', 'replace') if charset else None,
+               structure[5].decode('ascii', 'replace') if structure[5] else '7bit')
+
+
+# Locate the body part holding the message text
+def find_text_part(structure):
+    """
+    Finds the body part holding the message text within a parsed BODYSTRUCTURE.
+
+    Plain text parts are preferred over HTML, and attachments are skipped.
+    :param structure: Parsed BODYSTRUCTURE of a message
+    :return: Tuple of (section, subtype, charset, encoding) or None if no text part exists
+    """
+    text_parts = list(_iter_text_parts(structure))
+    for subtype in ('plain', 'html'):
+        for text_part in text_parts:
+            if text_part[1] == subtype:
+                return text_part
+    return None
+
+
+# Download only the text part of each message
+def fetch_text_bodies(mail, structures):
+    """
+    Downloads and decodes only the text part of each message.
+
+    Messages whose text part shares a section number are fetched together in a
+    single command, and BODY.PEEK leaves their \\Seen flag untouched.
+    :param mail: Logged-in IMAP connection with a mailbox selected
+    :param structures: Mapping of message UID to its parsed BODYSTRUCTURE
+    :return: Mapping of message UID to its decoded body text; messages without a text
+             part map to an empty string, and messages whose body could not be read are left out
+    """
+    bodies = {}
+    text_parts = {}
+    sections = {}
+    for uid, structure in structures.items():
+        if not structure:
+            print(f"Missing structure for message {uid.decode()}")
+            continue
+        try:
+            text_part = find_text_part(structure)
+        except Exception as e:
+            print(f"Error reading the structure of message {uid.decode()}: {e}")
+            continue
+        if text_part is None:
+            bodies[uid] = ''
+        else:
+            text_parts[uid] = text_part
+            sections.setdefault(text_part[0], []).append(uid)
+
+    for section, uids in sections.items():
+        status, data = mail.uid('fetch', b','.join(uids), f'(BODY.PEEK[{section}])')
+        if status != 'OK':
+            print(f"Error fetching the body of messages {b','.join(uids).decode()}: {data}")
+            continue
+        for uid, item in parse_fetch_response(data).items():
+            if uid not in text_parts:
+                continue
+            _, _, charset, encoding = text_parts[uid]
+            content = next((value for key, value in item.items() if key.startswith(b'BODY[')), None)
+            if content is None:
+                print(f"Missing body for message {uid.decode()}")
+                continue
+            try:
+                bodies[uid] = get_email_body(content, charset, encoding)
+            except Exception as e:
+                print(f"Error decoding the body of message {uid.decode()}: {e}")
+    return bodies
 
 
 # Check if an email message is a reply
@@ -117,9 +488,8 @@ def is_reply(email_message):
     :param email_message: Email message object
     :return: True if it is a reply, False otherwise
     """
-    if email_message['subject'].startswith('Re:'):
-        return True
-    return email_message.get('In-Reply-To') is not None or email_message.get('References') is not None
+    subject_is_reply = (email_message['subject'] or '').startswith('Re:')
+    return subject_is_reply or 'In-Reply-To' in email_message or 'References' in email_message
 
 
 # Extract filename from the email subject
@@ -130,7 +500,7 @@ def extract_filename(subject):
     :param subject: Email subject line
     :return: Extracted filename or None if not found
     """
-    match = re.search(r'\[([^\]]+)\]', subject)
+    match = _FILENAME_RE.search(subject or '')
     return match.group(1) if match else None
 
 
@@ -139,18 +509,22 @@ def process_email_text(text):
     """
     Processes the text content of an email to extract relevant data.
 
-    The function splits the text into lines and searches each line for specific patterns.
+    The function scans the whole text once for lines with the SKU/UPC column layout.
     :param text: Raw text content of an email
     :return: A list of extracted data
     """
-    lines = text.strip().split('\n')
-    extracted_data = []
-    for line in lines:
-        match = re.search(r'^\s*(\d\s+\d{5}\s+\d{5}\s+\d)\s+P', line)
-        if match:
-            sku_upc = match.group(1).replace(' ', '')
-            extracted_data.append(sku_upc)
-    return extracted_data
+    return [''.join(match.groups()) for match in _SKU_RE.finditer(text)]
+
+
+# Format extracted data as CSV rows
+def _format_rows(data):
+    """
+    Formats each extracted SKU/UPC as the fields of one CSV row.
+
+    :param data: List of extracted data
+    :return: List of comma-separated rows without line endings
+    """
+    return [f'{item},{item},,0,discontinued' for item in data]
 
 
 # Write data to a CSV file
@@ -158,14 +532,135 @@ def write_to_csv(data, filename):
     """
     Writes provided data into a CSV file.
 
-    Each row of data is written to the file in a specific format.
+    Each row is formatted once; the file content and the email body are both built
+    from those rows with a single join each, and the file is written in binary mode
+    with a single call.
     :param data: List of data to be written
     :param filename: Name of the CSV file to be created
+    :return: The same data as CSV text for an email body, without the file's trailing commas
+    :raises FileExistsError: If a file with that name already exists
+    """
+    rows = _format_rows(data)
+    file_body = ',\n'.join(rows) + ',\n' if rows else ''
+    email_body = '\n'.join(rows) + '\n' if rows else ''
+    with open(filename, 'xb', buffering=1 << 20) as file:
+        file.write(b'SKU,UPC,EAN,QUANTITY_AVAILABLE,STATUS,\n' + file_body.encode())
+    return 'SKU,UPC,EAN,QUANTITY_AVAILABLE,STATUS\n' + email_body
+
+
+# Per-thread SMTP and SFTP connections for the message workers
+class WorkerConnections:
+    """
+    Lazily opens one SMTP connection and one SFTP session per worker thread.
+
+    Every connection is tracked so that all of them can be closed once the batch is done.
     """
-    with open(filename, 'w') as file:
-        file.write('SKU,UPC,EAN,QUANTITY_AVAILABLE,STATUS,\n')
-        for item in data:
-            file.write(f'{item},{item},,0,discontinued,\n')
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._smtp_servers = []
+        self._ssh_clients = []
+
+    def smtp(self):
+        """
+        Returns the calling thread's SMTP connection, opening it on first use.
+
+        :return: Authenticated SMTP connection
+        """
+        server = getattr(self._local, 'smtp_server', None)
+        if server is None:
+            server = connect_smtp()
+            self._local.smtp_server = server
+            with self._lock:
+                self._smtp_servers.append(server)
+        return server
+
+    def sftp(self, hostname, port, username, password):
+        """
+        Returns the calling thread's SFTP session, opening it on first use.
+
+        :param hostname: SFTP server hostname
+        :param port: SFTP server port
+        :param username: SFTP username
+        :param password: SFTP password
+        :return: Open SFTP session
+        """
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            ssh_client, sftp = connect_sftp(hostname, port, username, password)
+            self._local.sftp = sftp
+            with self._lock:
+                self._ssh_clients.append(ssh_client)
+        return sftp
+
+    def close_all(self):
+        """
+        Closes every connection opened by any worker thread.
+        """
+        for server in self._smtp_servers:
+            try:
+                server.quit()
+            except Exception as e:
+                print(f"Error closing SMTP connection: {e}")
+        for ssh_client in self._ssh_clients:
+            ssh_client.close()
+
+
+# Write data to a new CSV file with a unique name
+def write_unique_csv(data):
+    """
+    Writes provided data into a new CSV file named nordsvcp_<timestamp>.csv.
+
+    If a file with that name already exists, whether from this run or an earlier one,
+    a counter suffix is added (nordsvcp_<timestamp>_1.csv, ...) so no file is overwritten.
+    :param data: List of data to be written
+    :return: Tuple of the filename used and the CSV text for an email body
+    """
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    filename = f'nordsvcp_{timestamp}.csv'
+    suffix = 0
+    while True:
+        try:
+            return filename, write_to_csv(data, filename)
+        except FileExistsError:
+            suffix += 1
+            filename = f'nordsvcp_{timestamp}_{suffix}.csv'
+
+
+# Handle a single fetched email message
+def handle_message(msg, body, connections):
+    """
+    Processes one email message.
+
+    Replies trigger an SFTP upload of the approved file; other messages have their
+    data written to a CSV file and sent out for approval. Upload and send failures
+    are raised so that the message is not marked as seen.
+    :param msg: Email message object holding the message headers
+    :param body: Decoded body text of the message
+    :param connections: Connections shared by the worker threads
+    """
+    subject = msg['subject']
+
+    if is_reply(msg):
+        filename = extract_filename(subject)
+        if filename:
+            print(f"Reply successful and found filename: {filename}")
+            # Upload the file via SFTP
+            sftp = connections.sftp(settings.sftp_hostname, settings.sftp_port,
+                                    settings.sftp_username, settings.sftp_password)
+            sftp_upload_file(sftp, settings.local_file_path + filename, settings.remote_path)
+    else:
+        extracted_data = process_email_text(body)
+
+        # Generate a unique filename and write data to a CSV file, keeping the CSV text
+        # for the email body
+        unique_filename, csv_data = write_unique_csv(extracted_data)
+
+        # Prepare and send an email with the CSV data
+        outgoing_subject = f"{APPROVAL_SUBJECT}: [{unique_filename}]"
+        outgoing_body = f"Filename: {unique_filename}\nhas been received.\nDoes this look correct?\n\n{csv_data}"
+        send_email(connections.smtp(), outgoing_subject, outgoing_body, settings.email_recipients)
 
 
 # Fetch and process emails from an IMAP server
@@ -174,57 +669,67 @@ def fetch_emails():
     Connects to an IMAP server, fetches unread emails, and processes them.
 
     The function extracts email content, processes it, writes data to a CSV file,
-    and if required, uploads the file via SFTP.
+    and if required, uploads the file via SFTP. Messages are handled concurrently
+    by a pool of worker threads.
     """
     try:
-        mail = imaplib.IMAP4_SSL(hostname)
-        mail.login(username, password)
+        mail = TunedIMAP4_SSL(settings.email_hostname)
+        mail.login(settings.email_username, settings.email_password)
         mail.select('inbox')
         print("trying email inbox")
 
-        status, messages = mail.uid('search', None, 'UNSEEN')
-        messages = messages[0].split()
-
-        for uid in messages:
-            status, data = mail.uid('fetch', uid, '(RFC822)')
-            for response_part in data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    subject = msg['subject']
-
-                    if is_reply(msg):
-                        filename = extract_filename(subject)
-                        if filename:
-                            print(f"Reply successful and found filename: {filename}")
-                            # Load SFTP details from environment variables
-                            sftp_hostname = os.getenv("SFTP_HOSTNAME")
-                            sftp_port = os.getenv("SFTP_PORT")
-                            sftp_username = os.getenv("SFTP_USERNAME")
-                            sftp_password = os.getenv("SFTP_PWORD")
-                            local_file_path = os.getenv("LOCAL_FILE_PATH") + filename
-                            remote_path = os.getenv("REMOTE_PATH")
-
-                            # Upload the file via SFTP
-                            sftp_upload_file(sftp_hostname, sftp_port, sftp_username, sftp_password, local_file_path, remote_path)
-                    else:
-                        body = get_email_body(msg)
-                        extracted_data = process_email_text(body)
-
-                        # Format the extracted data as CSV for email body
-                        csv_data = 'SKU,UPC,EAN,QUANTITY_AVAILABLE,STATUS\n'
-                        for item in extracted_data:
-                            csv_data += f'{item},{item},,0,discontinued\n'
-
-                        # Generate a unique filename and write data to a CSV file
-                        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                        unique_filename = f'nordsvcp_{timestamp}.csv'
-                        write_to_csv(extracted_data, unique_filename)
-                        mail.uid('store', uid, '+FLAGS', '\\Seen')
-
-                        # Prepare and send an email with the CSV data
-                        outgoing_subject = f"DSVNord Closeout Approval: [{unique_filename}]"
-                        outgoing_body = f"Filename: {unique_filename}\nhas been received.\nDoes this look correct?\n\n{csv_data}"
-                        send_email(outgoing_subject, outgoing_body, EMAIL_RECIPIENTS)
+        # Let the server split the inbox: new messages carry no reply headers, and the only
+        # replies worth fetching are the ones to our approval emails
+        status, new_messages = mail.uid('search', None, 'UNSEEN', 'NOT', 'HEADER', 'In-Reply-To', '""',
+                                        'NOT', 'HEADER', 'References', '""')
+        status, reply_messages = mail.uid('search', None, 'UNSEEN', 'SUBJECT', f'"{APPROVAL_SUBJECT}"',
+                                          'OR', 'HEADER', 'In-Reply-To', '""', 'HEADER', 'References', '""')
+        messages = sorted(set(new_messages[0].split()) | set(reply_messages[0].split()), key=int)
+
+        if messages:
+            # Fetch the headers and MIME structure of all unseen messages in a single round-trip
+            uid_set = b','.join(messages)
+            status, data = mail.uid('fetch', uid_set, '(BODY.PEEK[HEADER] BODYSTRUCTURE)')
+            fetched = []
+            for uid, item in parse_fetch_response(data).items():
+                header = item.get(b'BODY[HEADER]')
+                if not header:
+                    print(f"Missing headers for message {uid.decode()}, leaving it unread")
+                    continue
+                msg = email.message_from_bytes(header, policy=email.policy.default)
+                fetched.append((uid, msg, item.get(b'BODYSTRUCTURE')))
+
+            # Download only the text part of the messages that need their body processed
+            bodies = fetch_text_bodies(mail, {uid: structure for uid, msg, structure in fetched if not is_reply(msg)})
+
+            # Hand every message to the worker pool
+            connections = WorkerConnections()
+            handled = []
+            try:
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    futures = {}
+                    for uid, msg, structure in fetched:
+                        if is_reply(msg):
+                            body = ''
+                        elif uid in bodies:
+                            body = bodies[uid]
+                        else:
+                            # Leave the message unread so that it is retried on the next run
+                            print(f"Body of message {uid.decode()} could not be read, leaving it unread")
+                            continue
+                        futures[uid] = executor.submit(handle_message, msg, body, connections)
+                for uid, future in futures.items():
+                    try:
+                        future.result()
+                        handled.append(uid)
+                    except Exception as e:
+                        print(f'Error processing message {uid.decode()}: {e}')
+            finally:
+                connections.close_all()
+
+            # Mark every successfully handled message as seen with a single STORE
+            if handled:
+                mail.uid('store', b','.join(handled), '+FLAGS', '\\Seen')
 
         mail.close()
         mail.logout()
@@ -233,4 +738,5 @@ def fetch_emails():
         print(f'An error occurred: {e}')
 
 
-fetch_emails()
+if __name__ == '__main__':
+    fetch_emails()